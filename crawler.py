@@ -1,74 +1,150 @@
 import os
-import json
+import hashlib
 import time
+import random
 import logging
+import threading
+import multiprocessing
+from email.utils import parsedate_to_datetime
+from statistics import median
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
+import orjson
 import requests
+import zstandard
 from lxml import etree
-from huggingface_hub import HfApi, create_repo
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from huggingface_hub import CommitOperationAdd, HfApi, create_repo
 
 # ---------------- CONFIGURATION ----------------
 SRU_URL = "https://repository.overheid.nl/sru"
-CQL_QUERY = "c.product-area==lokalebekendmakingen"   # Lokale Bekendmakingen
+# Query, source label and target repo can be overridden so the same crawler
+# serves other collections (e.g. c.product-area==officielepublicaties).
+CQL_QUERY = os.getenv("CQL_QUERY", "c.product-area==lokalebekendmakingen")
 SRU_VERSION = "2.0"
 BATCH_SIZE = 1000              # Max per request
+CONCURRENCY = 4                # SRU pages fetched in parallel
+PREFETCH = 2 * CONCURRENCY     # Pages queued ahead of the writer
+PARSE_WORKERS = os.cpu_count() or 1  # Processes parsing record XML
+PARSE_CHUNKSIZE = 32           # Records sent to a parse worker at a time
+AIMD_ALPHA = 0.5               # Additive concurrency increase per fast response
+AIMD_BETA = 0.5                # Multiplicative decrease on errors/overruns
+LATENCY_OVERRUN = 2.0          # Overrun = latency above this × median latency
+QUOTA_FLOOR = 0.1              # Pause when <10% of the rate-limit quota remains
+MIN_INTERVAL = 0.25            # Minimum seconds between SRU request starts
 STATE_PATH = "crawler_state.json"
-OUTPUT_JSONL = "output.jsonl"
-HF_REPO_ID = "vGassen/Dutch-Lokale-Bekendmakingen"
-SOURCE = "Lokale Bekendmakingen"
-SHARD_SIZE = 300               # ≤300 records per HF push
-LOGLEVEL = logging.INFO
+SEEN_PATH = "crawler_seen.bin"  # Append-only log of 16-byte URL digests
+SHARD_PATTERN = "data_shard_{index:05d}.jsonl.zst"
+ZSTD_LEVEL = 3
+HF_REPO_ID = os.getenv("HF_REPO_ID", "vGassen/Dutch-Lokale-Bekendmakingen")
+SOURCE = os.getenv("SOURCE_LABEL", "Lokale Bekendmakingen")
+SHARD_SIZE = 300               # ≤300 records per shard file
+SHARDS_PER_COMMIT = 10         # Shards uploaded together in one HF commit
+IO_BUFFER = 1 << 16            # 64 KiB file buffers for JSONL I/O
+MAX_RETRIES = 5                # Attempts per SRU page / HF commit
+BACKOFF_BASE = 1.0             # Seconds; retry n waits up to BASE * 2**n
+LOGLEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 # ------------------------------------------------
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s", level=LOGLEVEL
 )
+logger = logging.getLogger(__name__)
 
-def load_state() -> int:
+# Compiled once and reused for every record. The SRU response namespace is
+# declared explicitly rather than matched with a `{*}` wildcard.
+SRU_NS = "http://docs.oasis-open.org/ns/search-ws/sruResponse"
+RECORD_DATA_TAG = f"{{{SRU_NS}}}recordData"
+SRU_PARAMS = {
+    "version": SRU_VERSION,
+    "operation": "searchRetrieve",
+    "query": CQL_QUERY,
+    "maximumRecords": BATCH_SIZE
+}
+# First locationURI, identifier, meta and body of a record, fetched in one
+# evaluation and told apart by tag in parse_record.
+_RECORD_PARTS_XPATH = etree.XPath(
+    "(.//locationURI)[1] | (.//identifier)[1] | (.//meta)[1] | (.//body)[1]"
+)
+
+DEFAULT_STATE = {"start_record": 1, "shard_index": 0, "shard_count": 0, "shard_offset": 0}
+
+def load_state() -> Dict[str, int]:
     if Path(STATE_PATH).exists():
-        with open(STATE_PATH, "r") as f:
-            return json.load(f).get("start_record", 1)
-    return 1
+        return {**DEFAULT_STATE, **orjson.loads(Path(STATE_PATH).read_bytes())}
+    return dict(DEFAULT_STATE)
+
+def save_state(state: Dict[str, int]):
+    # Write-then-rename so a crash mid-write never leaves a corrupt state file.
+    tmp_path = f"{STATE_PATH}.tmp"
+    Path(tmp_path).write_bytes(orjson.dumps(state))
+    os.replace(tmp_path, STATE_PATH)
+
+DIGEST_SIZE = 16
+
+def url_digest(url: str) -> bytes:
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=DIGEST_SIZE).digest()
+
+def load_seen() -> set[bytes]:
+    if not Path(SEEN_PATH).exists():
+        return set()
+    data = Path(SEEN_PATH).read_bytes()
+    # Ignore a partial digest left by a crash during the last append.
+    end = len(data) - len(data) % DIGEST_SIZE
+    return {data[i:i + DIGEST_SIZE] for i in range(0, end, DIGEST_SIZE)}
 
-def save_state(start_record: int):
-    with open(STATE_PATH, "w") as f:
-        json.dump({"start_record": start_record}, f)
+def append_seen(digests: List[bytes]):
+    if digests:
+        with open(SEEN_PATH, "ab", buffering=IO_BUFFER) as f:
+            f.write(b"".join(digests))
+
+_HTML_PARSER = etree.HTMLParser(recover=True)
+# Whitespace-only text nodes carry nothing once text is whitespace-collapsed.
+_RECORD_PARSER = etree.XMLParser(remove_blank_text=True)
+
+def element_text(el: etree._Element) -> str:
+    return " ".join(" ".join(el.itertext()).split())
 
 def strip_html(text: str) -> str:
+    # Most metadata values are plain text; only parse when there is markup
+    # or an entity to resolve.
+    if "<" not in text and "&" not in text:
+        return " ".join(text.split())
     try:
-        parser = etree.HTMLParser(recover=True)
-        root = etree.fromstring(f"<div>{text}</div>", parser=parser)
-        cleaned = " ".join(root.itertext())
-        return " ".join(cleaned.split())
+        root = etree.fromstring(f"<div>{text}</div>", parser=_HTML_PARSER)
+        return element_text(root)
     except Exception:
         return text
 
 def parse_record(record_xml: bytes) -> Dict[str, str] | None:
     try:
-        root = etree.fromstring(record_xml)
+        root = etree.fromstring(record_xml, parser=_RECORD_PARSER)
+        found = {el.tag: el for el in _RECORD_PARTS_XPATH(root)}
         # Find the URL in enrichedData/locationURI if present
         url = ""
-        url_el = root.find(".//locationURI")
+        url_el = found.get("locationURI")
         if url_el is not None and url_el.text:
             url = url_el.text.strip()
         # Gather content from meta, body, fallback to all text
         parts = []
-        meta = root.find(".//meta")
+        meta = found.get("meta")
         if meta is not None:
             for e in meta.iter():
                 if e.text and e.tag not in ["identifier", "locationURI"]:
-                    parts.append(e.text)
-        body = root.find(".//body")
+                    parts.append(strip_html(e.text))
+        body = found.get("body")
         if body is not None:
-            parts.append(strip_html(etree.tostring(body, encoding="unicode")))
+            parts.append(strip_html(element_text(body)))
         if not parts:
-            parts.append(strip_html(etree.tostring(root, encoding="unicode")))
-        content = "\n".join(parts)
-        content = strip_html(content)
+            parts.append(strip_html(element_text(root)))
+        content = " ".join(p for p in parts if p)
         if not url:
             # fallback: use identifier if locationURI missing
-            id_el = root.find(".//identifier")
+            id_el = found.get("identifier")
             url = id_el.text.strip() if id_el is not None and id_el.text else ""
         return {
             "URL": url,
@@ -76,96 +152,416 @@ def parse_record(record_xml: bytes) -> Dict[str, str] | None:
             "Source": SOURCE
         }
     except Exception as ex:
-        logging.warning(f"Failed to parse record: {ex}")
+        logger.warning("Failed to parse record: %s", ex)
         return None
 
-def fetch_batch(start_record: int) -> List[Dict[str, str]]:
-    params = {
-        "version": SRU_VERSION,
-        "operation": "searchRetrieve",
-        "query": CQL_QUERY,
-        "startRecord": start_record,
-        "maximumRecords": BATCH_SIZE
-    }
-    for retry in range(5):
+class RateLimiter:
+    """Reactive rate limiter with AIMD concurrency control for one host.
+
+    Callers bracket each request with ``wait_if_throttled()`` and
+    ``release(resp, latency, ok)``. Rate-limit headers pause all callers, and
+    the concurrency limit grows by ``alpha`` on responses at or near the median
+    latency and is multiplied by ``beta`` on 429/5xx, connection or read
+    errors, or latency overruns. Request starts are spaced at least ``min_interval``
+    apart.
+    """
+
+    def __init__(self, max_concurrency: int, alpha: float = AIMD_ALPHA,
+                 beta: float = AIMD_BETA, window: int = 50,
+                 min_interval: float = MIN_INTERVAL):
+        self.max_concurrency = max_concurrency
+        self.alpha = alpha
+        self.beta = beta
+        self.min_interval = min_interval
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.next_start = 0.0
+        self.latencies = deque(maxlen=window)
+        self.cond = threading.Condition()
+
+    def wait_if_throttled(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                delay = max(self.paused_until, self.next_start) - now
+                if delay <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.cond.wait(delay if delay > 0 else None)
+            self.in_flight += 1
+            self.next_start = now + self.min_interval
+
+    def release(self, resp: requests.Response | None, latency: float, ok: bool = True):
+        with self.cond:
+            self.in_flight -= 1
+            if resp is not None:
+                self._read_headers(resp)
+            if not ok or resp is None or resp.status_code in (429, 502, 503, 504):
+                self.limit = max(1.0, self.limit * self.beta)
+            else:
+                target = median(self.latencies) if self.latencies else latency
+                self.latencies.append(latency)
+                if latency > target * LATENCY_OVERRUN:
+                    self.limit = max(1.0, self.limit * self.beta)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + self.alpha)
+            self.cond.notify_all()
+
+    def _read_headers(self, resp: requests.Response):
+        pause = 0.0
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after:
+            pause = max(pause, _parse_retry_after(retry_after))
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        limit = resp.headers.get("X-RateLimit-Limit")
+        reset = resp.headers.get("X-RateLimit-Reset")
         try:
-            resp = requests.get(SRU_URL, params=params, timeout=60)
-            resp.raise_for_status()
-            root = etree.fromstring(resp.content)
-            records = root.findall(".//{*}recordData")
-            batch = []
-            for r in records:
-                # Some SRU XML wraps <recordData><gzd>...</gzd></recordData>
-                gzd = r[0] if len(r) > 0 else r
-                rec_xml = etree.tostring(gzd, encoding="utf-8")
-                doc = parse_record(rec_xml)
-                if doc and doc["Content"].strip():
-                    batch.append(doc)
-            logging.info(f"Fetched batch: {len(batch)} records (startRecord={start_record})")
-            return batch
+            if remaining is not None and limit is not None and reset is not None:
+                if float(remaining) < float(limit) * QUOTA_FLOOR:
+                    reset_s = float(reset)
+                    # Some servers send an epoch timestamp, others a delta.
+                    if reset_s > 1e9:
+                        reset_s -= time.time()
+                    pause = max(pause, reset_s)
+        except ValueError:
+            pass
+        if pause > 0:
+            logger.info("Rate limited by server, pausing %.1fs", pause)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+def _parse_retry_after(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return 0.0
+
+LIMITER = RateLimiter(CONCURRENCY)
+
+# One pooled session shared by all fetch threads so TCP/TLS connections
+# are reused. The adapter does not retry: fetch_batch owns retries, so every
+# 429, 5xx and connection error reaches LIMITER and is retried in one place,
+# with full-jitter backoff, instead of also inside urllib3.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=CONCURRENCY,
+    max_retries=0,
+))
+# SRU XML is highly repetitive. Advertise every encoding urllib3 can decode
+# here (gzip/deflate, plus br when brotli is installed); fetch_batch streams
+# the decoded body straight into iterparse.
+SESSION.headers.update({
+    "Accept": "application/xml",
+    "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+    "User-Agent": f"FRBR-Dutch-Lokale-Bekendmakingen-Sync (+https://huggingface.co/datasets/{HF_REPO_ID})",
+})
+
+def http_status(ex: Exception) -> int | None:
+    response = getattr(ex, "response", None)
+    return getattr(response, "status_code", None)
+
+def is_transient(ex: Exception) -> bool:
+    # Client errors other than 429 (bad query, auth) will fail again.
+    status = http_status(ex)
+    return status is None or status == 429 or status >= 500
+
+def backoff(retry: int):
+    # Full jitter: parallel workers that failed together do not retry together.
+    time.sleep(random.uniform(0, BACKOFF_BASE * 2 ** retry))
+
+def fetch_batch(start_record: int, parse_pool: Executor | None = None
+                ) -> Tuple[int, List[Dict[str, str]]]:
+    """Fetch one SRU page; returns (records on the page, parsed docs).
+
+    Record XML is split out while streaming and parsed afterwards, in
+    ``parse_pool`` when given so the CPU-bound work runs outside the GIL.
+    """
+    params = {**SRU_PARAMS, "startRecord": start_record}
+    for retry in range(MAX_RETRIES):
+        try:
+            resp = None
+            ok = False
+            LIMITER.wait_if_throttled()
+            started = time.monotonic()
+            # The slot is held until the streamed body has been read, so the
+            # limiter sees the full transfer time and mid-body failures.
+            try:
+                resp = SESSION.get(SRU_URL, params=params, timeout=60, stream=True)
+                with resp:
+                    resp.raise_for_status()
+                    resp.raw.decode_content = True
+                    rec_xmls = []
+                    # Stream the response: each recordData is serialized as soon as
+                    # it is complete and then dropped, so the full page is never built.
+                    for _, r in etree.iterparse(resp.raw, events=("end",), tag=RECORD_DATA_TAG):
+                        # Some SRU XML wraps <recordData><gzd>...</gzd></recordData>
+                        gzd = r[0] if len(r) > 0 else r
+                        rec_xmls.append(etree.tostring(gzd, encoding="utf-8"))
+                        r.clear()
+                        record = r.getparent()
+                        if record is not None:
+                            while record.getprevious() is not None:
+                                del record.getparent()[0]
+                ok = True
+            finally:
+                LIMITER.release(resp, time.monotonic() - started, ok)
+            if parse_pool is not None:
+                docs = parse_pool.map(parse_record, rec_xmls, chunksize=PARSE_CHUNKSIZE)
+            else:
+                docs = map(parse_record, rec_xmls)
+            batch = [d for d in docs if d and d["Content"].strip()]
+            logger.info("Fetched batch: %d records (startRecord=%d)", len(batch), start_record)
+            return len(rec_xmls), batch
         except Exception as ex:
-            logging.warning(f"Fetch batch failed (attempt {retry+1}): {ex}")
-            time.sleep(2 ** retry)
+            if not is_transient(ex):
+                raise
+            logger.warning("Fetch batch failed (attempt %d): %s", retry + 1, ex)
+            backoff(retry)
     raise RuntimeError("Failed to fetch batch after retries")
 
-def append_jsonl(records: List[Dict[str, str]], path: str):
-    with open(path, "a", encoding="utf-8") as f:
-        for r in records:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-
-def shard_jsonl(path: str, shard_size: int) -> List[str]:
-    shards = []
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    for i in range(0, len(lines), shard_size):
-        shard_path = f"{path}_shard_{i}_{i+shard_size}.jsonl"
-        with open(shard_path, "w", encoding="utf-8") as s:
-            s.writelines(lines[i:i+shard_size])
-        shards.append(shard_path)
-    return shards
+class ShardWriter:
+    """Write records into numbered zstd-compressed JSONL shards of at most
+    ``shard_size`` lines.
+
+    ``position()`` ends the current zstd frame and is stored in the crawler
+    state after every batch; on resume the open shard is truncated back to
+    the saved offset, so records written after the last checkpoint are not
+    duplicated when re-fetched. A shard is a valid multi-frame zstd file.
+    """
+
+    def __init__(self, shard_size: int, index: int = 0, count: int = 0, offset: int = 0):
+        self.shard_size = shard_size
+        self.index = index
+        self.count = count
+        self.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        if Path(self.path).exists():
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        else:
+            self.count = 0
+        self._open("ab")
+
+    def _open(self, mode: str):
+        self.raw = open(self.path, mode, buffering=IO_BUFFER)
+        self.file = self.cctx.stream_writer(self.raw)
+
+    @property
+    def path(self) -> str:
+        return SHARD_PATTERN.format(index=self.index)
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.shard_size
+
+    def write_many(self, records: List[Dict[str, str]]) -> List[str]:
+        """Write records, rotating as shards fill; returns the shards closed.
+
+        Each shard's slice of the batch is serialized and handed to the
+        compressor in a single write.
+        """
+        closed = []
+        i = 0
+        while i < len(records):
+            chunk = records[i:i + self.shard_size - self.count]
+            self.file.write(b"".join(orjson.dumps(r) + b"\n" for r in chunk))
+            self.count += len(chunk)
+            i += len(chunk)
+            if self.full:
+                closed.append(self.path)
+                self.rotate()
+        return closed
+
+    def position(self) -> Dict[str, int]:
+        self.file.flush(zstandard.FLUSH_FRAME)
+        self.raw.flush()
+        return {"shard_index": self.index, "shard_count": self.count,
+                "shard_offset": self.raw.tell()}
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def rotate(self):
+        self.close()
+        self.index += 1
+        self.count = 0
+        self._open("wb")
+
+@lru_cache(maxsize=None)
+def ensure_repo(token: str):
+    # One create_repo round-trip per run rather than one per push.
+    create_repo(HF_REPO_ID, repo_type="dataset", exist_ok=True, token=token)
 
 def push_to_hf(shard_paths: List[str]):
     token = os.getenv("HF_TOKEN")
     if not token:
         raise RuntimeError("Set HF_TOKEN env variable for Hugging Face access.")
     api = HfApi()
-    create_repo(HF_REPO_ID, repo_type="dataset", exist_ok=True, token=token)
-    for shard_path in shard_paths:
-        name = Path(shard_path).name
-        logging.info(f"Pushing {name} to HuggingFace ({HF_REPO_ID}) ...")
-        api.upload_file(
-            path_or_fileobj=shard_path,
-            path_in_repo=f"data/{name}",
-            repo_id=HF_REPO_ID,
-            repo_type="dataset",
-            token=token
-        )
-        logging.info(f"Uploaded: {name}")
+    ensure_repo(token)
+    names = [Path(p).name for p in shard_paths]
+    logger.info("Pushing %d shards to HuggingFace (%s) ...", len(names), HF_REPO_ID)
+    for retry in range(MAX_RETRIES):
+        try:
+            api.create_commit(
+                repo_id=HF_REPO_ID,
+                repo_type="dataset",
+                operations=[
+                    CommitOperationAdd(path_in_repo=f"data/{name}", path_or_fileobj=path)
+                    for name, path in zip(names, shard_paths)
+                ],
+                commit_message=f"Add {len(names)} shards",
+                token=token
+            )
+            break
+        except Exception as ex:
+            if not is_transient(ex) or retry == MAX_RETRIES - 1:
+                raise
+            logger.warning("Push failed (attempt %d): %s", retry + 1, ex)
+            backoff(retry)
+    logger.info("Uploaded: %s", ", ".join(names))
+
+class ShardUploader:
+    """Push batches of shards to Hugging Face on a background thread.
+
+    At most one commit is in flight; ``submit`` waits for the previous one.
+    ``take_done()`` returns the shards whose upload finished, which may be
+    deleted once the next checkpoint is saved.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.inflight = None
+        self.done = []
+
+    def _collect(self, wait: bool):
+        if self.inflight is not None and (wait or self.inflight[0].done()):
+            future, paths = self.inflight
+            self.inflight = None
+            future.result()
+            self.done.extend(paths)
+
+    def submit(self, paths: List[str]):
+        self._collect(wait=True)
+        self.inflight = (self.executor.submit(push_to_hf, paths), paths)
+
+    def take_done(self, wait: bool = False) -> List[str]:
+        self._collect(wait)
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def close_shard(writer: ShardWriter) -> str:
+    """Finish the writer's current shard and start the next one."""
+    path = writer.path
+    writer.rotate()
+    return path
+
+def checkpoint(start_record: int, writer: ShardWriter, pushed: List[str],
+               new_seen: List[bytes]):
+    # The state goes first: URLs written after a crash point are re-fetched
+    # and must not already be marked as seen. Uploaded shards are only
+    # removed once the state pointing past them is on disk.
+    save_state({"start_record": start_record, **writer.position()})
+    append_seen(new_seen)
+    new_seen.clear()
+    for path in pushed:
+        os.remove(path)
+    pushed.clear()
 
 def main():
-    start_record = load_state()
+    state = load_state()
+    start_record = state["start_record"]
+    writer = ShardWriter(SHARD_SIZE, state["shard_index"], state["shard_count"],
+                         state["shard_offset"])
+    seen = load_seen()
+    new_seen = []
     all_count = 0
-    while True:
-        batch = fetch_batch(start_record)
-        if not batch:
-            logging.info("No more records. Finished.")
-            break
-        append_jsonl(batch, OUTPUT_JSONL)
-        all_count += len(batch)
-        start_record += len(batch)
-        save_state(start_record)
-        logging.info(f"Saved {all_count} total records so far. Next startRecord={start_record}")
-        # Shard and push after each batch or at the end
-        if all_count % SHARD_SIZE == 0:
-            shards = shard_jsonl(OUTPUT_JSONL, SHARD_SIZE)
-            push_to_hf(shards)
-            logging.info("Pushed all shards to Hugging Face.")
-            for s in shards:
-                os.remove(s)
-    # Final push for leftovers
-    shards = shard_jsonl(OUTPUT_JSONL, SHARD_SIZE)
-    push_to_hf(shards)
-    logging.info("Done: All data uploaded.")
+    # Closed shards still on disk from an interrupted run were never
+    # confirmed as uploaded; push them with the next commit.
+    ready = [SHARD_PATTERN.format(index=i) for i in range(writer.index)
+             if Path(SHARD_PATTERN.format(index=i)).exists()]
+    pushed = []
+    uploader = ShardUploader()
+    try:
+        # Parse workers are spawned rather than forked: forking while the
+        # fetch threads hold locks can deadlock the children.
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                 mp_context=multiprocessing.get_context("spawn")) as parse_pool, \
+                ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            # The pool fetches while this thread writes and the uploader
+            # pushes. PREFETCH pages are queued so workers stay busy; results
+            # are consumed in order so the state file always points at the
+            # first unprocessed record.
+            next_start = start_record
+            pending = deque()
+            try:
+                for _ in range(PREFETCH):
+                    pending.append(pool.submit(fetch_batch, next_start, parse_pool))
+                    next_start += BATCH_SIZE
+                while pending:
+                    page_size, batch = pending.popleft().result()
+                    if not page_size:
+                        logger.info("No more records. Finished.")
+                        break
+                    docs = []
+                    for doc in batch:
+                        # SRU offsets shift when records are added between runs,
+                        # so the same document can show up on two pages.
+                        if doc["URL"]:
+                            key = url_digest(doc["URL"])
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                            new_seen.append(key)
+                        docs.append(doc)
+                    ready.extend(writer.write_many(docs))
+                    all_count += len(docs)
+                    while len(ready) >= SHARDS_PER_COMMIT:
+                        uploader.submit(ready[:SHARDS_PER_COMMIT])
+                        ready = ready[SHARDS_PER_COMMIT:]
+                    pushed.extend(uploader.take_done())
+                    start_record += page_size
+                    checkpoint(start_record, writer, pushed, new_seen)
+                    logger.info("Saved %d total records so far. Next startRecord=%d", all_count, start_record)
+                    if page_size < BATCH_SIZE:
+                        logger.info("Last page reached. Finished.")
+                        break
+                    pending.append(pool.submit(fetch_batch, next_start, parse_pool))
+                    next_start += BATCH_SIZE
+            finally:
+                # Also on errors, so queued pages are not fetched for nothing
+                # while the pool shuts down.
+                for f in pending:
+                    f.cancel()
+        # Final push for leftovers
+        if writer.count:
+            ready.append(close_shard(writer))
+        for i in range(0, len(ready), SHARDS_PER_COMMIT):
+            uploader.submit(ready[i:i + SHARDS_PER_COMMIT])
+        pushed.extend(uploader.take_done(wait=True))
+        if pushed:
+            checkpoint(start_record, writer, pushed, new_seen)
+    finally:
+        # Shards whose upload finished before an error are removed so a
+        # restart does not push them again, but only those the saved state
+        # already points past; later ones are rewritten on resume.
+        try:
+            pushed.extend(uploader.take_done(wait=True))
+        except Exception as ex:
+            logger.warning("Shard upload failed: %s", ex)
+        uploader.close()
+        writer.close()
+        saved = {SHARD_PATTERN.format(index=i) for i in range(load_state()["shard_index"])}
+        for path in pushed:
+            if path in saved:
+                os.remove(path)
+    logger.info("Done: All data uploaded.")
 
 if __name__ == "__main__":
     main()